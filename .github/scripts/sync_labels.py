@@ -1,13 +1,69 @@
+import asyncio
+import http.client
 import json
 import os
+import re
 import sys
-import urllib.error
+import threading
+import time
 import urllib.parse
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:  # optional speedup; the workflow runs on a bare python3
+    orjson = None
 
 
 API = "https://api.github.com"
 GRAPHQL = "https://api.github.com/graphql"
+URL_SAFE_NAME = re.compile(r"[A-Za-z0-9._~-]+")
+MAX_CONNECTIONS = 20
+MAX_CONCURRENT_REPOS = 8
+MAX_CONCURRENT_MUTATIONS = 4
+USAGE_BATCH = 100
+MAX_ATTEMPTS = 5
+RETRY_STATUSES = {502, 503, 504}
+# Errors from a pooled keep-alive connection that the server has already closed.
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+# Stop pacing requests once this few remain in the current rate-limit window.
+RATE_LIMIT_FLOOR = 5
+# The workflow has a short timeout; longer waits give up instead of sleeping.
+MAX_RATE_LIMIT_WAIT = 60
+
+ORG_SNAPSHOT_QUERY = """query($org: String!, $cursor: String) {
+  organization(login: $org) {
+    repositories(first: 100, after: $cursor, isArchived: false) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        id
+        nameWithOwner
+        hasDiscussionsEnabled
+        labels(first: 100) {
+          pageInfo { hasNextPage endCursor }
+          nodes { name color description }
+        }
+      }
+    }
+  }
+}
+"""
+
+REPO_LABELS_QUERY = """query($id: ID!, $cursor: String) {
+  node(id: $id) {
+    ... on Repository {
+      labels(first: 100, after: $cursor) {
+        pageInfo { hasNextPage endCursor }
+        nodes { name color description }
+      }
+    }
+  }
+}
+"""
+
+
+class RateLimitError(Exception):
+    """GitHub kept rate limiting a request after every retry."""
 
 
 def token() -> str:
@@ -18,99 +74,277 @@ def token() -> str:
     return t
 
 
-def api(method: str, url: str, t: str, *, params=None, body=None):
-    if params:
-        url = f"{url}?{urllib.parse.urlencode(params)}"
-    data = None if body is None else json.dumps(body).encode("utf-8")
-    req = urllib.request.Request(
-        url,
-        data=data,
-        method=method,
-        headers={
+class Session:
+    """Keep-alive connections to the GitHub API, shared by the worker threads."""
+
+    def __init__(self, t: str):
+        self.headers = {
             "Authorization": f"Bearer {t}",
             "Accept": "application/vnd.github+json",
             "User-Agent": "admin-things",
-        },
+        }
+        self._idle: dict[tuple[str, str], list[http.client.HTTPConnection]] = {}
+        self._limits: dict[str, tuple[int, int]] = {}
+        self._lock = threading.Lock()
+
+    def _throttle(self, resource: str):
+        """Sleep until the rate-limit window resets if it is nearly used up."""
+        with self._lock:
+            remaining, reset = self._limits.get(resource, (RATE_LIMIT_FLOOR, 0))
+        wait = reset - time.time()
+        if remaining < RATE_LIMIT_FLOOR and 0 < wait <= MAX_RATE_LIMIT_WAIT:
+            time.sleep(wait)
+
+    def _track(self, headers):
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        resource = headers.get("X-RateLimit-Resource") or "core"
+        with self._lock:
+            self._limits[resource] = (int(remaining), int(reset))
+
+    def _connect(self, scheme: str, netloc: str) -> tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        return self._open(scheme, netloc), False
+
+    def _open(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return cls(netloc, timeout=30)
+
+    def _release(self, scheme: str, netloc: str, conn: http.client.HTTPConnection):
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(conn)
+
+    def request(self, method: str, url: str, data: bytes | None = None, *, idempotent=None):
+        """Return (status, headers, raw body), reusing an idle connection when possible.
+
+        idempotent defaults to True for GET/HEAD only; it allows a request whose response
+        was lost on a stale connection to be sent again.
+        """
+        if idempotent is None:
+            idempotent = method in ("GET", "HEAD")
+        parts = urllib.parse.urlsplit(url)
+        target = parts.path + (f"?{parts.query}" if parts.query else "")
+        headers = dict(self.headers)
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+        self._throttle("graphql" if parts.path.endswith("/graphql") else "core")
+        conn, reused = self._connect(parts.scheme, parts.netloc)
+        try:
+            try:
+                conn.request(method, target, body=data, headers=headers)
+            except STALE_CONNECTION_ERRORS:
+                # The server dropped this idle connection before the request got through;
+                # resend it once on a new one.
+                if not reused:
+                    raise
+                conn.close()
+                conn = self._open(parts.scheme, parts.netloc)
+                conn.request(method, target, body=data, headers=headers)
+                reused = False
+            try:
+                resp = conn.getresponse()
+            except STALE_CONNECTION_ERRORS:
+                # The request may already have been processed, so only replay idempotent ones.
+                # Timeouts are never retried.
+                if not (reused and idempotent):
+                    raise
+                conn.close()
+                conn = self._open(parts.scheme, parts.netloc)
+                conn.request(method, target, body=data, headers=headers)
+                resp = conn.getresponse()
+            raw = resp.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(parts.scheme, parts.netloc, conn)
+        self._track(resp.headers)
+        return resp.status, resp.headers, raw
+
+    def close(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+
+def dumps(obj) -> bytes:
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode("utf-8")
+
+
+def loads(raw: bytes):
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+
+def is_rate_limited(status: int, headers, raw: bytes) -> bool:
+    if status == 429:
+        return True
+    if status == 200 and b"RATE_LIMITED" in raw:
+        # GraphQL reports its rate limit as a 200 with a RATE_LIMITED error.
+        try:
+            errors = loads(raw).get("errors") or []
+        except Exception:
+            return False
+        return any(e.get("type") == "RATE_LIMITED" for e in errors)
+    if status != 403:
+        return False
+    return (
+        headers.get("Retry-After") is not None
+        or headers.get("X-RateLimit-Remaining") == "0"
+        or b"rate limit" in raw.lower()
     )
-    try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            raw = resp.read().decode("utf-8")
-            return None if not raw else json.loads(raw)
-    except urllib.error.HTTPError as e:
-        raw = e.read().decode("utf-8", errors="replace")
-        print(f"GitHub API error {e.code} {method} {url}: {raw[:2000]}", file=sys.stderr)
-        return None
-    except Exception as e:
-        print(f"GitHub API failed {method} {url}: {e}", file=sys.stderr)
-        return None
 
 
-def paged(path: str, t: str, *, params=None):
-    out: list[dict] = []
-    page = 1
-    while True:
-        p = dict(params or {})
-        p["per_page"] = 100
-        p["page"] = page
-        batch = api("GET", f"{API}{path}", t, params=p)
-        if batch is None:
+def retry_delay(headers, attempt: int) -> float:
+    backoff = 2**attempt
+    retry_after = headers.get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        return max(int(retry_after), backoff)
+    reset = headers.get("X-RateLimit-Reset")
+    if headers.get("X-RateLimit-Remaining") == "0" and reset:
+        return max(int(reset) - time.time(), backoff)
+    return backoff
+
+
+def api(method: str, url: str, session: Session, *, params=None, body=None, idempotent=None):
+    """Return the decoded response body; None on failure.
+
+    Rate-limited and transient 5xx responses are retried with backoff. RateLimitError is
+    raised when GitHub is still rate limiting after the last attempt.
+    """
+    if params:
+        url = f"{url}?{urllib.parse.urlencode(params)}"
+    data = None if body is None else dumps(body)
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            status, headers, raw = session.request(method, url, data, idempotent=idempotent)
+        except Exception as e:
+            print(f"GitHub API failed {method} {url}: {e}", file=sys.stderr)
             return None
-        if not batch:
-            return out
-        if not isinstance(batch, list):
-            print(f"Expected list from {path}", file=sys.stderr)
+
+        rate_limited = is_rate_limited(status, headers, raw)
+        if rate_limited or status in RETRY_STATUSES:
+            delay = retry_delay(headers, attempt)
+            last = attempt + 1 == MAX_ATTEMPTS
+            if rate_limited and (last or delay > MAX_RATE_LIMIT_WAIT):
+                raise RateLimitError(f"GitHub API rate limit {method} {url}")
+            if not last:
+                reason = "rate limited" if rate_limited else status
+                print(f"GitHub API {reason} {method} {url}: retrying in {delay:.0f}s", file=sys.stderr)
+                time.sleep(delay)
+                continue
+
+        try:
+            if status >= 300:
+                text = raw.decode("utf-8", errors="replace")
+                print(f"GitHub API error {status} {method} {url}: {text[:2000]}", file=sys.stderr)
+                return None
+            return None if not raw else loads(raw)
+        except Exception as e:
+            print(f"GitHub API failed {method} {url}: {e}", file=sys.stderr)
             return None
-        out.extend(batch)
-        page += 1
 
 
-def has_issues_or_prs(repo: str, label: str, t: str) -> bool | None:
-    data = api(
-        "GET",
-        f"{API}/repos/{repo}/issues",
-        t,
-        params={"state": "all", "labels": label, "per_page": 1},
+async def api_async(
+    method: str, url: str, session: Session, *, params=None, body=None, idempotent=None
+):
+    return await asyncio.to_thread(
+        api, method, url, session, params=params, body=body, idempotent=idempotent
     )
-    if data is None:
-        return None
-    if not isinstance(data, list):
-        return None
-    return len(data) > 0
 
 
-def has_discussions(repo: str, label: str, t: str) -> bool | None:
-    q = f'repo:{repo} label:"{label}"'
-    query = """query($q: String!) {
-  search(query: $q, type: DISCUSSION, first: 1) { discussionCount }
-}
-"""
-    data = api(
-        "POST",
-        GRAPHQL,
-        t,
-        body={"query": query, "variables": {"q": q}},
+async def gather_bounded(coros, limit: int):
+    """Like asyncio.gather, but with at most limit awaitables in flight.
+
+    Every awaitable settles before the first exception, if any, is re-raised.
+    """
+    sem = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with sem:
+            return await coro
+
+    results = await asyncio.gather(*(run(c) for c in coros), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def graphql(query: str, variables: dict, session: Session):
+    # Only read-only queries go through here, so a lost response can safely be retried.
+    data = await api_async(
+        "POST", GRAPHQL, session, body={"query": query, "variables": variables}, idempotent=True
     )
     if data is None or data.get("errors"):
+        if data is not None:
+            print(f"GitHub GraphQL errors: {data['errors']}", file=sys.stderr)
+        return None
+    return data.get("data")
+
+
+async def label_usage_batch(
+    repo: str, labels: list[str], discussions: bool, session: Session
+) -> list[tuple[bool, bool]] | None:
+    """Look up issue/PR and discussion usage for every label in one GraphQL query.
+
+    Discussion searches are left out when the repo has Discussions disabled.
+    """
+    params = ", ".join(f"$q{i}: String!" for i in range(len(labels)))
+    fields = "".join(
+        f"  i{i}: search(query: $q{i}, type: ISSUE, first: 0) {{ issueCount }}\n"
+        + (
+            f"  d{i}: search(query: $q{i}, type: DISCUSSION, first: 0) {{ discussionCount }}\n"
+            if discussions
+            else ""
+        )
+        for i in range(len(labels))
+    )
+    query = f"query({params}) {{\n{fields}}}\n"
+    variables = {f"q{i}": f'repo:{repo} label:"{label}"' for i, label in enumerate(labels)}
+    data = await graphql(query, variables, session)
+    if data is None:
         return None
     try:
-        return int(data["data"]["search"]["discussionCount"]) > 0
+        return [
+            (
+                int(data[f"i{i}"]["issueCount"]) > 0,
+                discussions and int(data[f"d{i}"]["discussionCount"]) > 0,
+            )
+            for i in range(len(labels))
+        ]
     except Exception:
         return None
 
 
-def list_repos(org: str, t: str):
-    repos = paged(f"/orgs/{org}/repos", t, params={"type": "all"})
-    if repos is None:
-        return []
-    return [r["full_name"] for r in repos if not r.get("archived")]
+async def label_usage(
+    repo: str, labels: list[str], discussions: bool, session: Session
+) -> dict[str, tuple[bool, bool] | None]:
+    # Search has no escape for '"' inside a quoted term, so those labels are left unchecked
+    # (None) and never deleted.
+    searchable = [l for l in labels if '"' not in l]
+    chunks = [searchable[i : i + USAGE_BATCH] for i in range(0, len(searchable), USAGE_BATCH)]
+    results = await asyncio.gather(
+        *(label_usage_batch(repo, c, discussions, session) for c in chunks)
+    )
+    usage: dict[str, tuple[bool, bool] | None] = dict.fromkeys(labels)
+    for chunk, result in zip(chunks, results):
+        for i, label in enumerate(chunk):
+            usage[label] = None if result is None else result[i]
+    return usage
 
 
-def list_labels(repo: str, t: str):
-    labels = paged(f"/repos/{repo}/labels", t)
-    if labels is None:
-        return []
+def normalize_labels(nodes) -> list[dict]:
     out = []
-    for l in labels:
+    for l in nodes:
         name = l.get("name")
         color = l.get("color")
         if not name or not color:
@@ -119,58 +353,114 @@ def list_labels(repo: str, t: str):
     return out
 
 
-def label_create(repo: str, name: str, color: str, description: str, t: str):
-    api(
+async def remaining_labels(repo_id: str, cursor: str, session: Session):
+    """Page through labels beyond the first 100 returned by the org snapshot."""
+    out: list[dict] = []
+    while True:
+        data = await graphql(REPO_LABELS_QUERY, {"id": repo_id, "cursor": cursor}, session)
+        if data is None:
+            return None
+        labels = data["node"]["labels"]
+        out.extend(labels["nodes"])
+        if not labels["pageInfo"]["hasNextPage"]:
+            return out
+        cursor = labels["pageInfo"]["endCursor"]
+
+
+async def fetch_org_snapshot(org: str, session: Session) -> tuple[dict[str, list[dict]], dict[str, bool]]:
+    """Return ({repo: labels}, {repo: has Discussions enabled}) for every non-archived repo."""
+    nodes: list[dict] = []
+    cursor = None
+    while True:
+        data = await graphql(ORG_SNAPSHOT_QUERY, {"org": org, "cursor": cursor}, session)
+        if data is None:
+            return {}, {}
+        repos = data["organization"]["repositories"]
+        nodes.extend(repos["nodes"])
+        if not repos["pageInfo"]["hasNextPage"]:
+            break
+        cursor = repos["pageInfo"]["endCursor"]
+
+    overflow = [r for r in nodes if r["labels"]["pageInfo"]["hasNextPage"]]
+    extra = await asyncio.gather(
+        *(remaining_labels(r["id"], r["labels"]["pageInfo"]["endCursor"], session) for r in overflow)
+    )
+
+    snapshot = {r["nameWithOwner"]: r["labels"]["nodes"] for r in nodes}
+    for r, labels in zip(overflow, extra):
+        repo = r["nameWithOwner"]
+        if labels is None:
+            print(f"Skipping {repo}: could not list all labels", file=sys.stderr)
+            del snapshot[repo]
+            continue
+        snapshot[repo] = snapshot[repo] + labels
+    discussions = {r["nameWithOwner"]: bool(r["hasDiscussionsEnabled"]) for r in nodes}
+    return {repo: normalize_labels(labels) for repo, labels in snapshot.items()}, discussions
+
+
+async def label_create(repo: str, name: str, color: str, description: str, session: Session):
+    await api_async(
         "POST",
         f"{API}/repos/{repo}/labels",
-        t,
+        session,
         body={"name": name, "color": color, "description": description},
     )
 
 
-def label_update(repo: str, name: str, color: str, description: str, t: str):
-    enc = urllib.parse.quote(name, safe="")
-    api(
+def quote_label(name: str) -> str:
+    """Encode a label name for use as a URL path segment."""
+    return name if URL_SAFE_NAME.fullmatch(name) else urllib.parse.quote(name, safe="")
+
+
+async def label_update(repo: str, enc: str, color: str, description: str, session: Session):
+    await api_async(
         "PATCH",
         f"{API}/repos/{repo}/labels/{enc}",
-        t,
+        session,
         body={"color": color, "description": description},
     )
 
 
-def label_delete(repo: str, name: str, t: str):
-    enc = urllib.parse.quote(name, safe="")
-    api("DELETE", f"{API}/repos/{repo}/labels/{enc}", t)
+async def label_delete(repo: str, enc: str, session: Session):
+    await api_async("DELETE", f"{API}/repos/{repo}/labels/{enc}", session)
 
-def sync_labels(repo, target_labels):
-    t = token()
-    existing_labels = {l["name"]: l for l in list_labels(repo, t)}
+def normalize_targets(target_labels: list[dict]) -> dict[str, tuple[str, str]]:
+    return {l["name"]: (l["color"].lower(), l["description"]) for l in target_labels}
 
-    for target in target_labels:
-        name = target["name"]
-        color = target["color"]
-        description = target["description"]
 
-        if name in existing_labels:
-            existing = existing_labels[name]
-            if existing["color"].lower() != color.lower() or existing["description"] != description:
-                print(f"Updating label '{name}' in {repo}")
-                label_update(repo, name, color, description, t)
-        else:
-            print(f"Creating label '{name}' in {repo}")
-            label_create(repo, name, color, description, t)
+async def sync_labels(repo, labels, targets, encoded_names, session):
+    """Create or update labels so the repo matches targets ({name: (color, description)})."""
+    existing = {l["name"]: (l["color"].lower(), l["description"]) for l in labels}
+    to_create = [name for name in targets if name not in existing]
+    to_update = [name for name, want in targets.items() if name in existing and existing[name] != want]
 
-def cleanup_labels(repo, target_label_names):
-    t = token()
-    existing_labels = list_labels(repo, t)
-    extra_labels = [l["name"] for l in existing_labels if l["name"] not in target_label_names]
+    mutations = []
+    for name in to_update:
+        color, description = targets[name]
+        print(f"Updating label '{name}' in {repo}")
+        mutations.append(label_update(repo, encoded_names[name], color, description, session))
+    for name in to_create:
+        color, description = targets[name]
+        print(f"Creating label '{name}' in {repo}")
+        mutations.append(label_create(repo, name, color, description, session))
+    # Each mutation touches a different label, so they can run side by side.
+    await gather_bounded(mutations, MAX_CONCURRENT_MUTATIONS)
 
-    for label in extra_labels:
-        used_in_issues_or_prs = has_issues_or_prs(repo, label, t)
-        used_in_discussions = has_discussions(repo, label, t)
+async def cleanup_labels(repo, labels, target_label_names, discussions, session) -> list[dict]:
+    """Delete unused extra labels and return usage rows for the ones kept."""
+    extra_labels = [l["name"] for l in labels if l["name"] not in target_label_names]
 
+    try:
+        usage = await label_usage(repo, extra_labels, discussions, session) if extra_labels else {}
+    except RateLimitError as e:
+        print(f"Skipping cleanup for {repo}: {e}", file=sys.stderr)
+        return []
+
+    kept = []
+    to_delete = []
+    for label in extra_labels:
         # Fail safe: if any usage-check failed, do not delete.
-        checks_failed = used_in_issues_or_prs is None or used_in_discussions is None
+        checks_failed = usage[label] is None
         if checks_failed:
             print(
                 f"Skipping deletion check for label '{label}' in {repo}: "
@@ -179,30 +469,97 @@ def cleanup_labels(repo, target_label_names):
             )
             continue
 
+        used_in_issues_or_prs, used_in_discussions = usage[label]
         if not used_in_issues_or_prs and not used_in_discussions:
             print(f"Deleting unused label '{label}' from {repo}")
-            label_delete(repo, label, t)
+            to_delete.append(label)
         else:
             print(f"Keeping label '{label}' in {repo}: in use")
+            kept.append(
+                {
+                    "repo": repo,
+                    "label": label,
+                    "issues_or_prs": used_in_issues_or_prs,
+                    "discussions": used_in_discussions,
+                }
+            )
+
+    await gather_bounded(
+        (label_delete(repo, quote_label(label), session) for label in to_delete),
+        MAX_CONCURRENT_MUTATIONS,
+    )
+    return kept
+
+async def process_repo(
+    repo, labels, discussions, sem, targets, encoded_names, target_label_names, session
+):
+    async with sem:
+        print(f"Processing {repo}...")
+        try:
+            await sync_labels(repo, labels, targets, encoded_names, session)
+            return await cleanup_labels(repo, labels, target_label_names, discussions, session)
+        except RateLimitError as e:
+            print(f"Stopping {repo}: {e}", file=sys.stderr)
+            return []
+
+
+def print_usage_report(per_repo_usage):
+    """Print one ::group:: per repo; each item holds a single repo's rows, already grouped."""
+    for rows in per_repo_usage:
+        if not rows:
+            continue
+        print(f"::group::Extra labels in {rows[0]['repo']}")
+        for row in rows:
+            usage = (("issues/PRs", row["issues_or_prs"]), ("discussions", row["discussions"]))
+            where = [name for name, used in usage if used]
+            print(f"  {row['label']}: used in {', '.join(where)}")
+        print("::endgroup::")
+
 
-def main():
+async def main():
     org = "ChecKMarKDevTools"
     labels_file = ".github/org-labels.json"
 
-    t = token()
+    session = Session(token())
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=MAX_CONNECTIONS)
+    )
 
     with open(labels_file, "r") as f:
         target_labels = json.load(f)
 
-    target_label_names = [l["name"] for l in target_labels]
-    repos = list_repos(org, t)
+    targets = normalize_targets(target_labels)
+    target_label_names = set(targets)
+    encoded_names = {name: quote_label(name) for name in targets}
+    try:
+        try:
+            snapshot, discussions = await fetch_org_snapshot(org, session)
+        except RateLimitError as e:
+            print(f"Could not list repos in {org}: {e}", file=sys.stderr)
+            sys.exit(1)
+
+        sem = asyncio.Semaphore(MAX_CONCURRENT_REPOS)
+        results = await asyncio.gather(
+            *(
+                process_repo(
+                    repo,
+                    labels,
+                    discussions[repo],
+                    sem,
+                    targets,
+                    encoded_names,
+                    target_label_names,
+                    session,
+                )
+                for repo, labels in snapshot.items()
+            )
+        )
+    finally:
+        session.close()
 
-    for repo in repos:
-        print(f"Processing {repo}...")
-        sync_labels(repo, target_labels)
-        cleanup_labels(repo, target_label_names)
+    print_usage_report(results)
 
     print("Done.")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())